@@ -1,15 +1,23 @@
 import argparse
 import bz2
+import codecs
+import fnmatch
+import functools
 import gzip
 import os
 import re
 import sys
+import threading
 import time
 import urllib.request
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
 from pathlib import Path
-from typing import Iterable, List, Optional, Set, Tuple
-from urllib.parse import urljoin, urlparse
+from queue import Queue
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urldefrag, urljoin, urlparse
 
 
 def eprint(*args, **kwargs):
@@ -71,11 +79,7 @@ def parse_filenames_from_packages(text: str) -> List[str]:
     out: List[str] = []
     for line in text.splitlines():
         if line.lower().startswith('filename:'):
-            val = line.split(':', 1)[1].strip()
-            # Normalize: strip leading ./
-            while val.startswith('./'):
-                val = val[2:]
-            out.append(val)
+            out.append(normalize_filename(line.split(':', 1)[1].strip()))
     # Deduplicate preserving order
     seen: Set[str] = set()
     uniq: List[str] = []
@@ -86,30 +90,410 @@ def parse_filenames_from_packages(text: str) -> List[str]:
     return uniq
 
 
-def parse_deb_hrefs_from_html(html: str, base_url: str) -> List[str]:
-    # Very light parser for directory listings; find hrefs ending with .deb
-    hrefs: List[str] = []
-    for m in re.finditer(r'href\s*=\s*["\']([^"\'#?]+)["\']', html, re.IGNORECASE):
-        href = m.group(1)
-        if href.lower().endswith('.deb'):
-            # Build absolute URL then try to convert to relative
-            base = base_url if base_url.endswith('/') else base_url + '/'
-            abs_url = urljoin(base, href)
-            if abs_url.startswith(base):
-                rel = abs_url[len(base):]
-            else:
-                rel = abs_url
-            hrefs.append(rel)
-    # Deduplicate
-    seen: Set[str] = set()
-    out: List[str] = []
-    for h in hrefs:
-        if h not in seen:
-            seen.add(h)
-            out.append(h)
+def normalize_filename(val: str) -> str:
+    # Normalize: strip leading ./
+    while val.startswith('./'):
+        val = val[2:]
+    return val
+
+
+def parse_package_records(text: str) -> List[Dict[str, str]]:
+    # One dict per stanza; keys keep their original case, continuation lines are folded in
+    records: List[Dict[str, str]] = []
+    cur: Dict[str, str] = {}
+    last_key: Optional[str] = None
+    for line in text.splitlines():
+        if not line.strip():
+            if cur:
+                records.append(cur)
+            cur, last_key = {}, None
+            continue
+        if line[0] in ' \t' and last_key:
+            cur[last_key] += '\n' + line.strip()
+            continue
+        if ':' in line:
+            k, v = line.split(':', 1)
+            last_key = k.strip()
+            cur[last_key] = v.strip()
+    if cur:
+        records.append(cur)
+    return records
+
+
+def rec_get(rec: Dict[str, str], key: str) -> str:
+    if key in rec:
+        return rec[key]
+    key_lc = key.lower()
+    for k, v in rec.items():
+        if k.lower() == key_lc:
+            return v
+    return ''
+
+
+def split_version(ver: str) -> Tuple[int, str, str]:
+    # [epoch:]upstream[-revision]
+    epoch = 0
+    if ':' in ver:
+        e, ver = ver.split(':', 1)
+        try:
+            epoch = int(e)
+        except ValueError:
+            epoch = 0
+    upstream, sep, revision = ver.rpartition('-')
+    if not sep:
+        upstream, revision = ver, ''
+    return epoch, upstream, revision
+
+
+def _char_order(c: str) -> int:
+    # dpkg ordering: '~' sorts before everything (even the end of the string),
+    # letters sort before non-letters
+    if c == '~':
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+def _compare_part(a: str, b: str) -> int:
+    i = j = 0
+    while i < len(a) or j < len(b):
+        # Non-digit prefix, compared char by char
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ca = _char_order(a[i]) if i < len(a) and not a[i].isdigit() else 0
+            cb = _char_order(b[j]) if j < len(b) and not b[j].isdigit() else 0
+            if ca != cb:
+                return -1 if ca < cb else 1
+            i += 1
+            j += 1
+        # Digit run, compared numerically
+        si = i
+        while i < len(a) and a[i].isdigit():
+            i += 1
+        sj = j
+        while j < len(b) and b[j].isdigit():
+            j += 1
+        na = int(a[si:i] or 0)
+        nb = int(b[sj:j] or 0)
+        if na != nb:
+            return -1 if na < nb else 1
+    return 0
+
+
+def compare_versions(a: str, b: str) -> int:
+    """Compare two Debian version strings like dpkg --compare-versions; returns -1, 0 or 1."""
+    ea, ua, ra = split_version(a.strip())
+    eb, ub, rb = split_version(b.strip())
+    if ea != eb:
+        return -1 if ea < eb else 1
+    return _compare_part(ua, ub) or _compare_part(ra, rb)
+
+
+version_key = functools.cmp_to_key(compare_versions)
+
+
+def keep_latest_records(records: List[Dict[str, str]], keep: int) -> List[Dict[str, str]]:
+    # Keep the newest `keep` versions per (Package, Architecture), preserving index order
+    groups: Dict[Tuple[str, str], List[Dict[str, str]]] = {}
+    for rec in records:
+        groups.setdefault((rec_get(rec, 'Package'), rec_get(rec, 'Architecture')), []).append(rec)
+    kept: Set[int] = set()
+    for recs in groups.values():
+        recs.sort(key=lambda r: version_key(rec_get(r, 'Version')), reverse=True)
+        kept.update(id(r) for r in recs[:keep])
+    return [r for r in records if id(r) in kept]
+
+
+FILTER_FIELDS = {'package': 'Package', 'section': 'Section', 'architecture': 'Architecture', 'arch': 'Architecture'}
+
+
+@dataclass
+class PackageFilter:
+    # Patterns are shell globs, either bare (matched against Package) or
+    # Field=glob with Field one of Package/Section/Architecture. Include
+    # patterns are OR-ed; any exclude match drops the record.
+    include: List[str] = field(default_factory=list)
+    exclude: List[str] = field(default_factory=list)
+    with_deps: bool = False
+    latest: Optional[int] = None
+
+    def active(self) -> bool:
+        return bool(self.include or self.exclude or self.with_deps or self.latest)
+
+    def key(self) -> Tuple:
+        # Hashable, order-insensitive identity used to deduplicate identical requests
+        return (tuple(sorted(self.include)), tuple(sorted(self.exclude)), self.with_deps, self.latest)
+
+
+def _pattern_matches(rec: Dict[str, str], pattern: str) -> bool:
+    fld, sep, glob = pattern.partition('=')
+    if sep and fld.strip().lower() in FILTER_FIELDS:
+        key = FILTER_FIELDS[fld.strip().lower()]
+    else:
+        key, glob = 'Package', pattern
+    return fnmatch.fnmatchcase(rec_get(rec, key).lower(), glob.strip().lower())
+
+
+def _is_excluded(rec: Dict[str, str], flt: PackageFilter) -> bool:
+    return any(_pattern_matches(rec, p) for p in flt.exclude)
+
+
+def filter_records(records: List[Dict[str, str]], flt: PackageFilter) -> List[Dict[str, str]]:
+    out: List[Dict[str, str]] = []
+    for rec in records:
+        if flt.include and not any(_pattern_matches(rec, p) for p in flt.include):
+            continue
+        if _is_excluded(rec, flt):
+            continue
+        out.append(rec)
+    return out
+
+
+RELATION_RE = re.compile(r"^([^\s(\[:]+)(?::\S+)?\s*(?:\(\s*(<<|<=|>=|>>|=|<|>)\s*([^)\s]+)\s*\))?")
+
+
+def parse_relations(value: str) -> List[List[Tuple[str, Optional[str], Optional[str]]]]:
+    # "a (>= 1), b | c:any" -> [[('a', '>=', '1')], [('b', None, None), ('c', None, None)]]
+    groups: List[List[Tuple[str, Optional[str], Optional[str]]]] = []
+    for part in value.split(','):
+        alts: List[Tuple[str, Optional[str], Optional[str]]] = []
+        for alt in part.split('|'):
+            m = RELATION_RE.match(alt.strip())
+            if m:
+                alts.append((m.group(1), m.group(2), m.group(3)))
+        if alts:
+            groups.append(alts)
+    return groups
+
+
+def parse_depends(value: str) -> List[List[str]]:
+    # "a (>= 1), b | c:any" -> [['a'], ['b', 'c']]
+    return [[name for name, _, _ in alts] for alts in parse_relations(value)]
+
+
+def version_satisfies(ver: str, op: Optional[str], want: Optional[str]) -> bool:
+    if not op or want is None:
+        return True
+    c = compare_versions(ver, want)
+    # Bare '<' and '>' are obsolete dpkg spellings of '<=' and '>='
+    return {'<<': c < 0, '<=': c <= 0, '<': c <= 0, '=': c == 0,
+            '>=': c >= 0, '>': c >= 0, '>>': c > 0}[op]
+
+
+def build_name_index(records: List[Dict[str, str]]) -> Dict[str, List[Dict[str, str]]]:
+    # Package name (and virtual names from Provides) -> records
+    index: Dict[str, List[Dict[str, str]]] = {}
+    for rec in records:
+        name = rec_get(rec, 'Package')
+        if name:
+            index.setdefault(name, []).append(rec)
+        for group in parse_depends(rec_get(rec, 'Provides')):
+            for virt in group:
+                if virt != name:
+                    index.setdefault(virt, []).append(rec)
+    return index
+
+
+def resolve_dependency_closure(selected: List[Dict[str, str]], records: List[Dict[str, str]], flt: PackageFilter) -> List[Dict[str, str]]:
+    index = build_name_index(records)
+    out: List[Dict[str, str]] = []
+    seen: Set[int] = set()
+    queue = deque(selected)
+    while queue:
+        rec = queue.popleft()
+        if id(rec) in seen:
+            continue
+        seen.add(id(rec))
+        out.append(rec)
+        arch = rec_get(rec, 'Architecture')
+        deps = ', '.join(v for v in (rec_get(rec, 'Pre-Depends'), rec_get(rec, 'Depends')) if v)
+        for alts in parse_relations(deps):
+            # First alternative available in this index wins; the rest are
+            # expected to come from elsewhere (e.g. the device's base system).
+            for name, op, want in alts:
+                cands = []
+                for c in index.get(name, []):
+                    if _is_excluded(c, flt):
+                        continue
+                    # Never pull another architecture's build; arch 'all' fits anything
+                    if arch != 'all' and rec_get(c, 'Architecture') not in (arch, 'all'):
+                        continue
+                    if rec_get(c, 'Package') == name:
+                        ok = version_satisfies(rec_get(c, 'Version'), op, want)
+                    else:
+                        # Provided (virtual) names carry no version of their own
+                        ok = op is None
+                    if ok:
+                        cands.append(c)
+                if not cands:
+                    continue
+                # Newest satisfying candidate per architecture: a concrete parent
+                # only sees its own arch (plus 'all'), while an 'all' parent needs
+                # the dependency for every arch the index ships it for.
+                best: Dict[str, Dict[str, str]] = {}
+                for c in cands:
+                    c_arch = rec_get(c, 'Architecture')
+                    if c_arch not in best or compare_versions(rec_get(c, 'Version'), rec_get(best[c_arch], 'Version')) > 0:
+                        best[c_arch] = c
+                if arch != 'all':
+                    # Same-arch build and an 'all' build are interchangeable; keep the newer
+                    queue.append(max(best.values(), key=lambda c: version_key(rec_get(c, 'Version'))))
+                else:
+                    queue.extend(best.values())
+                break
     return out
 
 
+def select_filenames(text: str, flt: PackageFilter) -> List[str]:
+    if not flt.active():
+        return parse_filenames_from_packages(text)
+    records = parse_package_records(text)
+    if flt.latest:
+        # Prune before selection so the dependency closure also resolves to the newest versions
+        records = keep_latest_records(records, flt.latest)
+    selected = filter_records(records, flt)
+    if flt.with_deps:
+        selected = resolve_dependency_closure(selected, records, flt)
+    uniq: List[str] = []
+    seen: Set[str] = set()
+    for rec in selected:
+        fn = rec_get(rec, 'Filename')
+        if fn:
+            fn = normalize_filename(fn)
+            if fn not in seen:
+                seen.add(fn)
+                uniq.append(fn)
+    return uniq
+
+
+class LinkParser(HTMLParser):
+    # Streaming href collector: feed() chunks as they arrive, links accumulate in .links
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links: List[str] = []
+
+    def handle_starttag(self, tag: str, attrs):
+        if tag.lower() != 'a':
+            return
+        for k, v in attrs:
+            if k.lower() == 'href' and v:
+                self.links.append(v.strip())
+
+
+def stream_links(url: str, timeout: float = 20.0, retries: int = 2, delay: float = 1.0, user_agent: Optional[str] = None) -> List[str]:
+    headers = {"User-Agent": user_agent or "RepoDebFetcher/1.0"}
+    for attempt in range(retries + 1):
+        parser = LinkParser()
+        req = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                charset = resp.headers.get_content_charset() or 'utf-8'
+                decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+                for chunk in iter(lambda: resp.read(64 * 1024), b''):
+                    parser.feed(decoder.decode(chunk))
+                parser.feed(decoder.decode(b'', final=True))
+            parser.close()
+            return parser.links
+        except Exception:
+            if attempt < retries:
+                time.sleep(delay * (attempt + 1))
+            else:
+                raise
+    return []
+
+
+def _rel_or_abs(abs_url: str, base: str) -> str:
+    # Paths under the base URL are returned relative so downloads mirror the repo layout
+    return abs_url[len(base):] if abs_url.startswith(base) else abs_url
+
+
+def _split_links(page_url: str, links: List[str]) -> Tuple[List[str], List[str]]:
+    debs: List[str] = []
+    dirs: List[str] = []
+    for href in links:
+        if '?' in href or href.startswith(('#', 'mailto:', 'javascript:')):
+            continue
+        abs_url = urldefrag(urljoin(page_url, href))[0]
+        if urlparse(abs_url).scheme not in ('http', 'https'):
+            continue
+        if abs_url.lower().endswith('.deb'):
+            debs.append(abs_url)
+        elif abs_url.endswith('/'):
+            dirs.append(abs_url)
+    return debs, dirs
+
+
+def _crawl(base: str, max_depth: int, workers: int, extra_hosts: Set[str], max_pages: int, timeout: float,
+           retries: int, delay: float, user_agent: Optional[str], out: "Queue[Optional[str]]", stop: threading.Event):
+    visited: Set[str] = {base}
+    found: Set[str] = set()
+    pages = 1
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    pending: Dict[Future, Tuple[str, int]] = {
+        pool.submit(stream_links, base, timeout, retries, delay, user_agent): (base, 0)
+    }
+    try:
+        while pending and not stop.is_set():
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for fut in done:
+                page_url, depth = pending.pop(fut)
+                try:
+                    links = fut.result()
+                except Exception as ex:
+                    eprint(f"[crawl] {page_url}: {ex}")
+                    continue
+                debs, dirs = _split_links(page_url, links)
+                if depth < max_depth:
+                    for d in dirs:
+                        if d in visited:
+                            continue
+                        if not d.startswith(base) and urlparse(d).netloc.lower() not in extra_hosts:
+                            continue
+                        if pages >= max_pages:
+                            break
+                        visited.add(d)
+                        pages += 1
+                        pending[pool.submit(stream_links, d, timeout, retries, delay, user_agent)] = (d, depth + 1)
+                for u in debs:
+                    if u not in found:
+                        found.add(u)
+                        out.put(_rel_or_abs(u, base))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        out.put(None)
+
+
+def crawl_debs(base_url: str, max_depth: int = 3, workers: int = 4, hosts: Optional[Iterable[str]] = None,
+               max_pages: int = 500, timeout: float = 20.0, retries: int = 2, delay: float = 1.0,
+               user_agent: Optional[str] = None) -> Iterator[str]:
+    """Walk directory listings breadth-first from base_url and yield .deb paths as they are found.
+
+    The crawl runs in its own thread, so listing fetches continue while the
+    caller is busy downloading. Subdirectories are followed below the start
+    URL, or anywhere on one of `hosts`; .deb links are kept whatever their
+    host. Paths under base_url are yielded relative to it, others as
+    absolute URLs, matching what download_many expects.
+    """
+    base = base_url if base_url.endswith('/') else base_url + '/'
+    out: "Queue[Optional[str]]" = Queue()
+    stop = threading.Event()
+    threading.Thread(
+        target=_crawl,
+        args=(base, max_depth, workers, {h.lower() for h in (hosts or [])}, max_pages, timeout, retries, delay,
+              user_agent, out, stop),
+        daemon=True,
+    ).start()
+    try:
+        while True:
+            item = out.get()
+            if item is None:
+                return
+            yield item
+    finally:
+        # Consumer stopped early (e.g. --max reached): stop scheduling new listings
+        stop.set()
+
+
 def ensure_parent(path: Path):
     path.parent.mkdir(parents=True, exist_ok=True)
 
@@ -140,7 +524,10 @@ def download_many(base_url: str, rel_paths: Iterable[str], dest_root: Path, time
         try:
             ensure_parent(out_path)
             data = fetch_bytes(url, timeout=timeout, retries=retries, delay=delay, user_agent=user_agent)
-            out_path.write_bytes(data)
+            # Write then rename so concurrent runs sharing dest_root never see a partial file
+            tmp_path = out_path.with_name(out_path.name + f".part{os.getpid()}-{threading.get_ident()}")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, out_path)
             ok += 1
             print(f"[ok] -> {out_path} ({len(data)} bytes)")
             if delay > 0:
@@ -157,23 +544,29 @@ def main():
     gsrc = ap.add_mutually_exclusive_group(required=False)
     gsrc.add_argument('--packages-url', help='Full Packages(.gz/.bz2) URL to fetch instead of guessing')
     gsrc.add_argument('--packages-file', help='Local Packages file to parse (plain text, gz, or bz2 based on extension)')
-    ap.add_argument('--dir-list', action='store_true', help='Treat base-url as a directory listing and download all .deb links found there (no Packages needed)')
+    ap.add_argument('--dir-list', action='store_true', help='Treat base-url as a directory listing and download all .deb links found there or in its subdirectories (no Packages needed)')
+    ap.add_argument('--crawl-depth', type=int, default=3, help='Subdirectory levels to follow in directory listing mode (default 3, 0 = start page only)')
+    ap.add_argument('--crawl-workers', type=int, default=4, help='Concurrent listing fetches while crawling (default 4)')
+    ap.add_argument('--crawl-host', action='append', default=[], help='Extra host whose directory listings may be followed while crawling (repeatable; .deb links are kept from any host)')
+    ap.add_argument('--crawl-max-pages', type=int, default=500, help='Stop following subdirectories after N listing pages (default 500)')
     ap.add_argument('--output', default='downloads', help='Destination root folder (default: downloads)')
     ap.add_argument('--user-agent', help='Custom User-Agent header')
     ap.add_argument('--timeout', type=float, default=20.0, help='HTTP timeout seconds (default 20)')
     ap.add_argument('--retries', type=int, default=2, help='Retry attempts per request (default 2)')
     ap.add_argument('--delay', type=float, default=0.5, help='Delay seconds between downloads (default 0.5)')
     ap.add_argument('--max', type=int, help='Download at most N files')
+    ap.add_argument('--include', action='append', default=[], help='Only packages matching this glob; bare globs match Package, or use Section=GLOB / Architecture=GLOB (repeatable)')
+    ap.add_argument('--exclude', action='append', default=[], help='Skip packages matching this glob, same syntax as --include (repeatable)')
+    ap.add_argument('--latest', type=int, metavar='N', help='Keep only the newest N versions per Package/Architecture (dpkg version ordering)')
+    ap.add_argument('--with-deps', action='store_true', help='Also fetch the Depends/Pre-Depends closure of the selected packages found in the index')
     ap.add_argument('--dry-run', action='store_true', help='Only list actions without downloading')
     args = ap.parse_args()
 
-    # Directory listing mode
+    flt = PackageFilter(args.include, args.exclude, args.with_deps, args.latest)
+
+    crawl = False
     if args.dir_list:
-        html = fetch_bytes(args.base_url, timeout=args.timeout, retries=args.retries, delay=args.delay, user_agent=args.user_agent).decode('utf-8', errors='replace')
-        rel_paths = parse_deb_hrefs_from_html(html, args.base_url)
-        if not rel_paths:
-            raise SystemExit("No .deb links found in directory listing.")
-        print(f"Found {len(rel_paths)} files to fetch from listing.")
+        crawl = True
     elif args.packages_file:
         p = Path(args.packages_file)
         if not p.exists():
@@ -181,28 +574,36 @@ def main():
         data = p.read_bytes()
         src_url = p.name
         text = maybe_decompress(data, src_url)
-        rel_paths = parse_filenames_from_packages(text)
+        rel_paths = select_filenames(text, flt)
         if not rel_paths:
-            raise SystemExit("No Filename entries found in Packages.")
+            raise SystemExit("No Filename entries found in Packages (or none matched the filters).")
         print(f"Found {len(rel_paths)} files to fetch.")
     else:
         try:
             src_url, data = try_fetch_packages(args.base_url, args.packages_url, args.timeout, args.retries, args.delay, args.user_agent)
             text = maybe_decompress(data, src_url)
-            rel_paths = parse_filenames_from_packages(text)
+            rel_paths = select_filenames(text, flt)
             if not rel_paths:
-                raise SystemExit("No Filename entries found in Packages.")
+                raise SystemExit("No Filename entries found in Packages (or none matched the filters).")
             print(f"Found {len(rel_paths)} files to fetch.")
         except Exception as ex:
             print(f"Packages not found ({ex}). Trying directory listing mode...")
-            html = fetch_bytes(args.base_url, timeout=args.timeout, retries=args.retries, delay=args.delay, user_agent=args.user_agent).decode('utf-8', errors='replace')
-            rel_paths = parse_deb_hrefs_from_html(html, args.base_url)
-            if not rel_paths:
-                raise SystemExit("No .deb links found in directory listing.")
-            print(f"Found {len(rel_paths)} files to fetch from listing.")
+            crawl = True
+
+    if crawl:
+        # Directory listing mode: debs stream into download_many while the crawl continues
+        if flt.active():
+            # Mirroring the whole listing is exactly what the filters are meant to avoid
+            raise SystemExit("--include/--exclude/--with-deps/--latest need a Packages index; none found at the base URL.")
+        print(f"Crawling {args.base_url} (depth {args.crawl_depth}, {args.crawl_workers} workers)...")
+        rel_paths = crawl_debs(args.base_url, max_depth=args.crawl_depth, workers=args.crawl_workers, hosts=args.crawl_host,
+                               max_pages=args.crawl_max_pages, timeout=args.timeout, retries=args.retries, delay=args.delay,
+                               user_agent=args.user_agent)
 
     dest_root = Path(args.output).resolve()
     ok, skip, fail = download_many(args.base_url, rel_paths, dest_root, args.timeout, args.retries, args.delay, args.user_agent, args.dry_run, args.max)
+    if crawl and ok + skip + fail == 0:
+        raise SystemExit("No .deb links found in directory listing.")
     print(f"Done. ok={ok} skip={skip} fail={fail} dest={dest_root}")
 
 
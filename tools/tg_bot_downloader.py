@@ -1,13 +1,16 @@
+import hashlib
 import json
 import os
 import re
+import shutil
 import sys
 import threading
 import time
 import urllib.parse
 import urllib.request
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
 
 # Make repo root importable and import our downloader helpers
 REPO_ROOT = Path(__file__).resolve().parents[1]
@@ -22,8 +25,10 @@ try:
     from tools.download_repo_debs import (
         try_fetch_packages,
         maybe_decompress,
-        parse_filenames_from_packages,
+        select_filenames,
         download_many,
+        PackageFilter,
+        crawl_debs,
     )
 except Exception as ex:
     print("Failed to import downloader helpers:", ex)
@@ -124,10 +129,11 @@ def get_updates(offset: Optional[int], timeout: int = 50):
 URL_RE = re.compile(r"https?://[^\s]+", re.IGNORECASE)
 
 
-def parse_command(text: str) -> Tuple[Optional[str], Optional[int], Optional[float]]:
-    # Extract first URL, optional max=N and delay=S options
+def parse_command(text: str) -> Tuple[Optional[str], Optional[int], Optional[float], PackageFilter]:
+    # Extract first URL, optional max=N, delay=S, latest=N, include=a,b exclude=c and deps options
+    flt = PackageFilter()
     if not text:
-        return None, None, None
+        return None, None, None, flt
     m = URL_RE.search(text)
     url = m.group(0) if m else None
     max_n = None
@@ -144,22 +150,172 @@ def parse_command(text: str) -> Tuple[Optional[str], Optional[int], Optional[flo
             delay_s = float(m3.group(1))
         except ValueError:
             pass
-    return url, max_n, delay_s
+    m5 = re.search(r"\blatest\s*=\s*(\d+)", text, re.IGNORECASE)
+    if m5:
+        flt.latest = int(m5.group(1)) or None
+    for m4 in re.finditer(r"\b(include|exclude)\s*=\s*(\S+)", text, re.IGNORECASE):
+        pats = [p for p in m4.group(2).split(',') if p]
+        (flt.include if m4.group(1).lower() == 'include' else flt.exclude).extend(pats)
+    if re.search(r"(?<![\w/.=-])deps\b(?!\s*=)", text, re.IGNORECASE):
+        flt.with_deps = True
+    return url, max_n, delay_s, flt
+
+
+# Completed results are reused for this long; downloaded folders are evicted
+# (least recently used first) once their total size exceeds the byte limit.
+CACHE_TTL = 6 * 3600
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+DOWNLOADS = REPO_ROOT / 'downloads'
+
+
+def normalize_url(base_url: str) -> str:
+    up = urllib.parse.urlparse(base_url.strip())
+    return urllib.parse.urlunparse((up.scheme.lower(), up.netloc.lower(), up.path.rstrip('/'), '', up.query, ''))
+
+
+def job_key(base_url: str, max_n: Optional[int], flt: PackageFilter) -> Tuple:
+    # Requests with the same key produce the same files; delay only affects pacing
+    return (normalize_url(base_url), max_n, flt.key())
+
+
+def repo_dest(base_url: str) -> Path:
+    # Shared per-repo folder (whatever the filters): download_many skips files already
+    # present, so it acts as a deb cache. The hash keeps e.g. /a/b and /a_b apart.
+    url = normalize_url(base_url)
+    up = urllib.parse.urlparse(url)
+    host = up.netloc.replace(':', '_') or 'repo'
+    slug = re.sub(r'[^\w.-]+', '_', up.path.strip('/'))[:40] or 'root'
+    return DOWNLOADS / host / f"{slug}-{hashlib.sha1(url.encode('utf-8')).hexdigest()[:10]}"
+
+
+def dir_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class ResultCache:
+    # Not thread-safe by itself: callers hold `lock`. Nothing here walks or
+    # deletes a tree; evicted folders are renamed aside and returned so the
+    # caller can remove them after releasing the lock.
+    def __init__(self, ttl: float, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[Tuple, Tuple[float, Path, str]]" = OrderedDict()
+        # Every download folder on disk, least recently used first: path -> (last used, bytes)
+        self._folders: "OrderedDict[Path, Tuple[float, int]]" = OrderedDict()
+
+    def seed(self, root: Path):
+        # Account for folders left by a previous run (call before any job starts)
+        if not root.exists():
+            return
+        found = []
+        for host_dir in root.iterdir():
+            if host_dir.name.startswith('.trash-'):
+                shutil.rmtree(host_dir, ignore_errors=True)
+                continue
+            if not host_dir.is_dir():
+                continue
+            for dest in host_dir.iterdir():
+                if dest.is_dir():
+                    found.append((dest.stat().st_mtime, dest, dir_size(dest)))
+        for mtime, dest, size in sorted(found):
+            self._folders[dest] = (mtime, size)
+
+    def get(self, key: Tuple) -> Optional[str]:
+        item = self._items.get(key)
+        if not item:
+            return None
+        ts, dest, text = item
+        if time.time() - ts > self.ttl or not dest.exists():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        if dest in self._folders:
+            self._folders.move_to_end(dest)
+        return text
+
+    def put(self, key: Tuple, dest: Path, text: str, size: int, busy: List[Path]) -> List[Path]:
+        now = time.time()
+        self._items[key] = (now, dest, text)
+        self._items.move_to_end(key)
+        self._folders[dest] = (now, size)
+        self._folders.move_to_end(dest)
+        # The folder just reported to the waiters is never evicted by its own put
+        return self.evict(busy + [dest])
+
+    def evict(self, busy: List[Path]) -> List[Path]:
+        # Expired folders no live entry or running job uses go first, then least
+        # recently used ones until the total is under the size limit.
+        now = time.time()
+        for key in [k for k, (ts, _, _) in self._items.items() if now - ts > self.ttl]:
+            del self._items[key]
+        protected = set(busy) | {dest for _, dest, _ in self._items.values()}
+        victims = [d for d, (ts, _) in self._folders.items() if d not in protected and now - ts > self.ttl]
+        total = sum(size for d, (_, size) in self._folders.items() if d not in victims)
+        for dest, (_, size) in self._folders.items():
+            if total <= self.max_bytes:
+                break
+            if dest in busy or dest in victims:
+                continue
+            victims.append(dest)
+            total -= size
+        trash: List[Path] = []
+        for dest in victims:
+            del self._folders[dest]
+            for key in [k for k, (_, d, _) in self._items.items() if d == dest]:
+                del self._items[key]
+            # Renaming is cheap and frees the path at once for a new job on the same repo
+            aside = DOWNLOADS / f".trash-{dest.parent.name}-{dest.name}-{time.time_ns()}"
+            try:
+                os.replace(dest, aside)
+                trash.append(aside)
+            except OSError:
+                pass
+            print(f"[cache] evicted {dest}")
+        return trash
 
 
 class Job:
-    def __init__(self, chat_id: int, message_id: int, base_url: str, max_n: Optional[int], delay_s: Optional[float]):
-        self.chat_id = chat_id
-        self.message_id = message_id
+    def __init__(self, key: Tuple, base_url: str, max_n: Optional[int], delay_s: Optional[float],
+                 flt: Optional[PackageFilter] = None):
+        self.key = key
+        # (chat_id, message_id) of every chat waiting on this job
+        self.waiters: List[Tuple[int, int]] = []
         self.base_url = base_url
+        self.dest = repo_dest(base_url)
         self.max_n = max_n
         self.delay_s = delay_s
-        self.cancel = False
+        self.flt = flt or PackageFilter()
         self.thread = threading.Thread(target=self.run, daemon=True)
 
     def start(self):
         self.thread.start()
 
+    def finish(self, text: str, cacheable: bool):
+        size = dir_size(self.dest) if cacheable else 0
+        trash: List[Path] = []
+        with lock:
+            inflight.pop(self.key, None)
+            waiters = list(self.waiters)
+            for chat_id, _ in waiters:
+                if running.get(chat_id) is self:
+                    del running[chat_id]
+            if cacheable:
+                trash = results.put(self.key, self.dest, text, size, [j.dest for j in inflight.values()])
+        for path in trash:
+            shutil.rmtree(path, ignore_errors=True)
+        for chat_id, message_id in waiters:
+            try:
+                edit_message(chat_id, message_id, text)
+            except Exception as ex:
+                print("Notify error:", ex)
+
     def run(self):
         start_ts = time.time()
         try:
@@ -168,32 +324,21 @@ class Job:
             try:
                 pk_url, data = try_fetch_packages(self.base_url, None, timeout=20.0, retries=2, delay=0.5, user_agent="RepoDebFetcher/1.0")
                 text = maybe_decompress(data, pk_url)
-                files = parse_filenames_from_packages(text)
-            except Exception as ex:
-                # Fallback to directory listing scrape
-                html = urllib.request.urlopen(self.base_url, timeout=20).read().decode('utf-8', errors='replace')
-                # Reuse downloader's simple parser via a tiny inline function
-                files = []
-                for m in re.finditer(r'href\s*=\s*["\']([^"\'#?]+)["\']', html, re.IGNORECASE):
-                    href = m.group(1)
-                    if href.lower().endswith('.deb'):
-                        if href.startswith('http://') or href.startswith('https://'):
-                            files.append(href)
-                        else:
-                            base = self.base_url if self.base_url.endswith('/') else self.base_url + '/'
-                            files.append(urllib.parse.urljoin(base, href))
+                files = select_filenames(text, self.flt)
+            except Exception:
+                if self.flt.active():
+                    self.finish(f"الفلاتر (include/exclude/deps/latest) تتطلب ملف Packages، ولم أجده في {self.base_url}.", cacheable=False)
+                    return
+                # Fallback: crawl directory listings; debs are downloaded as they are discovered
+                files = crawl_debs(self.base_url, timeout=20.0, retries=2, delay=0.5, user_agent="RepoDebFetcher/1.0")
             if not files:
-                edit_message(self.chat_id, self.message_id, f"لم أجد أي ملفات .deb في {self.base_url}.")
+                self.finish(f"لم أجد أي ملفات .deb في {self.base_url}.", cacheable=False)
                 return
-            # Output folder: downloads/<host>/<timestamp>
-            host = urllib.parse.urlparse(self.base_url).netloc.replace(':', '_') or 'repo'
-            ts = time.strftime('%Y%m%d-%H%M%S', time.localtime(start_ts))
-            dest = REPO_ROOT / 'downloads' / host / ts
             # Start download
             ok, skip, fail = download_many(
                 self.base_url,
                 files,
-                dest_root=dest,
+                dest_root=self.dest,
                 timeout=20.0,
                 retries=2,
                 delay=self.delay_s if self.delay_s is not None else 0.5,
@@ -201,13 +346,20 @@ class Job:
                 dry_run=False,
                 max_items=self.max_n,
             )
+            if ok + skip + fail == 0:
+                self.finish(f"لم أجد أي ملفات .deb في {self.base_url}.", cacheable=False)
+                return
             dur = time.time() - start_ts
-            edit_message(self.chat_id, self.message_id, f"تم. ok={ok} skip={skip} fail={fail}\nالمجلد: {dest}\nالوقت: {dur:.1f}s")
+            self.finish(f"تم. ok={ok} skip={skip} fail={fail}\nالمجلد (ذاكرة مؤقتة مشتركة لهذا المستودع، قد يحتوي ملفات من طلبات أخرى): {self.dest}\nالوقت: {dur:.1f}s", cacheable=fail == 0)
         except Exception as ex:
-            edit_message(self.chat_id, self.message_id, f"فشل: {ex}")
+            self.finish(f"فشل: {ex}", cacheable=False)
 
 
+# All three are shared with job threads and guarded by `lock`
+lock = threading.Lock()
 running: Dict[int, Job] = {}
+inflight: Dict[Tuple, Job] = {}
+results = ResultCache(CACHE_TTL, CACHE_MAX_BYTES)
 
 
 def main():
@@ -223,6 +375,7 @@ def main():
     except Exception as ex:
         print("Invalid bot token or network issue:", ex)
         return
+    results.seed(DOWNLOADS)
     offset = None
     while True:
         try:
@@ -236,27 +389,54 @@ def main():
                 chat_id = chat.get("id")
                 text = msg.get("text") or ""
                 if text.strip().lower().startswith("/start"):
-                    send_message(chat_id, "أرسل رابط المستودع (https://...) ويمكن إضافة max=رقم و delay=ثانية، مثال:\nhttps://apt.example.com max=100 delay=0.2")
+                    send_message(chat_id, "أرسل رابط المستودع (https://...) ويمكن إضافة max=رقم و delay=ثانية و latest=رقم (أحدث الإصدارات فقط) و include=/exclude= (أنماط مفصولة بفواصل) و deps لجلب الاعتماديات، مثال:\nhttps://apt.example.com max=100 delay=0.2\nhttps://apt.example.com include=com.opa334.*,Section=Tweaks deps latest=1")
                     continue
                 if text.strip().lower().startswith("/cancel"):
-                    job = running.pop(chat_id, None)
+                    with lock:
+                        job = running.pop(chat_id, None)
+                        if job:
+                            # Stop waiting; the download itself keeps running and stays cacheable
+                            job.waiters = [w for w in job.waiters if w[0] != chat_id]
                     if job:
-                        job.cancel = True
                         send_message(chat_id, "تم طلب الإلغاء (قد يستغرق لحظات)")
                     else:
                         send_message(chat_id, "لا توجد مهمة قيد التنفيذ")
                     continue
-                url, max_n, delay_s = parse_command(text)
+                url, max_n, delay_s, flt = parse_command(text)
                 if not url:
                     send_message(chat_id, "لم أتعرف على رابط. أعد الإرسال بشكل: https://apt.example.com max=50")
                     continue
                 if chat_id in running:
                     send_message(chat_id, "مهمة قيد التنفيذ بالفعل. أرسل /cancel للإلغاء أولًا أو انتظر انتهاءها.")
                     continue
-                msg_id = send_message(chat_id, f"بدء التحميل من:\n{url}\nالخيارات: max={max_n or 'الكل'}, delay={delay_s or 0.5}s")
-                job = Job(chat_id, msg_id, url, max_n, delay_s)
-                running[chat_id] = job
-                job.start()
+                opts = f"max={max_n or 'الكل'}, delay={delay_s or 0.5}s"
+                if flt.include:
+                    opts += f", include={','.join(flt.include)}"
+                if flt.exclude:
+                    opts += f", exclude={','.join(flt.exclude)}"
+                if flt.latest:
+                    opts += f", latest={flt.latest}"
+                if flt.with_deps:
+                    opts += ", deps"
+                key = job_key(url, max_n, flt)
+                with lock:
+                    cached = results.get(key)
+                if cached:
+                    send_message(chat_id, f"(من الذاكرة المؤقتة)\n{cached}")
+                    continue
+                msg_id = send_message(chat_id, f"بدء التحميل من:\n{url}\nالخيارات: {opts}")
+                with lock:
+                    job = inflight.get(key)
+                    joined = job is not None
+                    if not job:
+                        job = Job(key, url, max_n, delay_s, flt)
+                        inflight[key] = job
+                    job.waiters.append((chat_id, msg_id))
+                    running[chat_id] = job
+                if joined:
+                    edit_message(chat_id, msg_id, f"نفس الطلب قيد التنفيذ بالفعل، سيتم إرسال النتيجة عند انتهائه:\n{url}")
+                else:
+                    job.start()
         except Exception as ex:
             print("Loop error:", ex)
             time.sleep(2)
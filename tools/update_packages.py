@@ -2,16 +2,26 @@ import argparse
 import bz2
 import gzip
 import hashlib
+import html
+import json
 import os
 import re
+import sys
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
+# Make repo root importable and import the shared version ordering
 REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from tools.download_repo_debs import version_key
 DEBS = REPO_ROOT / 'debs'
 PKG_FILE = REPO_ROOT / 'Packages'
 ICONS_DIR_DEFAULT = REPO_ROOT / 'icons'
+CATALOG_DIR = REPO_ROOT / 'catalog'
+CATALOG_PAGE_SIZE = 50
 EOL = "\r\n"  # keep CRLF for compatibility
 CHUNK = 1024 * 1024
 
@@ -82,6 +92,54 @@ def parse_deb_filename(name: str) -> Optional[Tuple[str, str, str]]:
     return pkg, ver, arch
 
 
+def resolve_deb(deb_name: str) -> Optional[Path]:
+    deb_path = DEBS / deb_name
+    if deb_path.exists():
+        return deb_path
+    # Try to find a deb with the same stem but with extra suffixes
+    if deb_name.endswith('.deb'):
+        candidates = sorted(DEBS.glob(deb_name[:-4] + '*.deb'))
+        if candidates:
+            return candidates[0]
+    return None
+
+
+def prune_superseded(stanzas: List[str], keep: int, verbose: bool) -> Tuple[List[str], List[Path]]:
+    # Rank by the stanzas' Package/Version/Architecture (filenames lose the epoch) and
+    # drop all but the newest `keep` per (package, arch). Only stanzas whose deb is
+    # present take part, so a stanza for a missing file never supersedes a real one.
+    # Returns the kept stanzas and the debs to delete once the new index is written.
+    groups: Dict[Tuple[str, str], List[Tuple[str, int]]] = {}
+    resolved: Dict[int, Path] = {}
+    for i, stanza in enumerate(stanzas):
+        lines = stanza.splitlines()
+        _, pkg = get_field(lines, 'Package')
+        _, ver = get_field(lines, 'Version')
+        _, arch = get_field(lines, 'Architecture')
+        _, filename_field = get_field(lines, 'Filename')
+        deb_path = resolve_deb(os.path.basename(filename_field)) if filename_field else None
+        if pkg and ver and deb_path:
+            resolved[i] = deb_path
+            groups.setdefault((pkg, arch or ''), []).append((ver, i))
+    dropped: Set[int] = set()
+    for items in groups.values():
+        items.sort(key=lambda x: version_key(x[0]), reverse=True)
+        dropped.update(i for _, i in items[keep:])
+    kept = [s for i, s in enumerate(stanzas) if i not in dropped]
+    # A deb still referenced by a kept stanza must survive
+    kept_files = {p for i, p in resolved.items() if i not in dropped}
+    doomed: List[Path] = []
+    for i in sorted(dropped):
+        lines = stanzas[i].splitlines()
+        _, pkg = get_field(lines, 'Package')
+        _, ver = get_field(lines, 'Version')
+        if verbose:
+            print(f"[prune] {pkg} {ver} ({resolved[i].name})")
+        if resolved[i] not in kept_files and resolved[i] not in doomed:
+            doomed.append(resolved[i])
+    return kept, doomed
+
+
 @dataclass
 class UpdatePlan:
     stanza_index: int
@@ -126,24 +184,17 @@ def build_update_plans(stanzas: List[str], only: Optional[set], fix_metadata: bo
         deb_name = os.path.basename(filename_field)
         if only and deb_name not in only:
             continue
-        deb_path = DEBS / deb_name
-        actual_name = deb_name
+        deb_path = resolve_deb(deb_name)
+        if deb_path is None:
+            if verbose:
+                print(f"[skip] missing deb: {deb_name}")
+            continue
+        actual_name = deb_path.name
         fix_filename = None
-        if not deb_path.exists():
-            # Try to find a deb with the same stem but with extra suffixes
-            if deb_name.endswith('.deb'):
-                stem = deb_name[:-4]
-                candidates = sorted(DEBS.glob(stem + '*.deb'))
-                if candidates:
-                    deb_path = candidates[0]
-                    actual_name = deb_path.name
-                    fix_filename = f"./debs/{actual_name}"
-                    if verbose:
-                        print(f"[match] Resolved {deb_name} -> {actual_name}")
-            if not deb_path.exists():
-                if verbose:
-                    print(f"[skip] missing deb: {deb_name}")
-                continue
+        if actual_name != deb_name:
+            fix_filename = f"./debs/{actual_name}"
+            if verbose:
+                print(f"[match] Resolved {deb_name} -> {actual_name}")
         size = deb_path.stat().st_size
         md5 = file_hash(deb_path, 'md5')
         sha1 = file_hash(deb_path, 'sha1')
@@ -233,6 +284,152 @@ def write_outputs(content: str, no_compress: bool):
         print(f"Wrote: Packages (backup: {backup.name})")
 
 
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+CATALOG_FIELDS = [
+    ('Package', 'id'), ('Name', 'name'), ('Version', 'ver'), ('Architecture', 'arch'),
+    ('Section', 'sec'), ('Author', 'author'), ('Description', 'desc'),
+    ('Filename', 'file'), ('Size', 'size'), ('Icon', 'icon'), ('Depiction', 'dep'),
+]
+
+
+def field_continuation(lines: List[str], key: str) -> str:
+    # Indented lines following a multi-line field (e.g. the long Description); ' .' marks a blank line
+    idx, _ = get_field(lines, key)
+    if idx is None:
+        return ''
+    out = []
+    for ln in lines[idx + 1:]:
+        if not ln[:1].isspace():
+            break
+        if ln.strip() != '.':
+            out.append(ln.strip())
+    return ' '.join(out)
+
+
+def stanza_to_record(stanza: str) -> Optional[Dict[str, object]]:
+    lines = stanza.splitlines()
+    rec: Dict[str, object] = {}
+    for key, short in CATALOG_FIELDS:
+        _, val = get_field(lines, key)
+        if val:
+            rec[short] = val
+    if 'id' not in rec:
+        return None
+    if 'size' in rec:
+        try:
+            rec['size'] = int(rec['size'])
+        except ValueError:
+            del rec['size']
+    # Search tokens: lowercase words from the browsable text fields, so clients
+    # can filter with a prefix match instead of scanning full descriptions.
+    words: set = set()
+    for short in ('id', 'name', 'sec', 'author', 'desc'):
+        words.update(TOKEN_RE.findall(str(rec.get(short, '')).lower()))
+    words.update(TOKEN_RE.findall(field_continuation(lines, 'Description').lower()))
+    rec['t'] = sorted(w for w in words if len(w) > 1)
+    return rec
+
+
+def build_catalog(stanzas: List[str]) -> List[Tuple[Dict[str, object], str]]:
+    # Pair each record with its source stanza so pages can be hashed by content
+    out: List[Tuple[Dict[str, object], str]] = []
+    for stanza in stanzas:
+        rec = stanza_to_record(stanza)
+        if rec:
+            out.append((rec, stanza.strip()))
+    out.sort(key=lambda x: (str(x[0].get('name', x[0]['id'])).lower(), x[0]['id'], x[0].get('arch', '')))
+    return out
+
+
+def _write_if_changed(path: Path, data: bytes) -> bool:
+    if path.exists() and path.read_bytes() == data:
+        return False
+    path.write_bytes(data)
+    return True
+
+
+def render_catalog_page(records: List[Dict[str, object]], page: int, has_next: bool) -> str:
+    # Only links to neighbouring pages, so a page stays valid when the page count changes
+    esc = html.escape
+    rows = []
+    for rec in records:
+        title = esc(str(rec.get('name', rec['id'])))
+        dep = rec.get('dep')
+        if dep:
+            title = f'<a href="{esc(str(dep))}">{title}</a>'
+        rows.append(
+            "<tr>"
+            f"<td>{title}<br><small>{esc(str(rec['id']))}</small></td>"
+            f"<td>{esc(str(rec.get('ver', '')))}</td>"
+            f"<td>{esc(str(rec.get('arch', '')))}</td>"
+            f"<td>{esc(str(rec.get('sec', '')))}</td>"
+            f"<td>{esc(str(rec.get('desc', '')))}</td>"
+            "</tr>"
+        )
+    nav = []
+    if page > 1:
+        nav.append(f'<a href="page-{page - 1}.html">&laquo; Prev</a>')
+    nav.append(f"Page {page}")
+    if has_next:
+        nav.append(f'<a href="page-{page + 1}.html">Next &raquo;</a>')
+    return (
+        '<!DOCTYPE html>\n<html lang="en">\n<head>\n'
+        '  <meta charset="UTF-8">\n'
+        '  <meta name="viewport" content="width=device-width, initial-scale=1.0">\n'
+        f"  <title>Packages - page {page}</title>\n"
+        '</head>\n<body>\n'
+        '  <p><a href="../index.html">Home</a> | <a href="../packages.json">packages.json</a></p>\n'
+        "  <table>\n"
+        "    <tr><th>Package</th><th>Version</th><th>Arch</th><th>Section</th><th>Description</th></tr>\n"
+        + "".join(f"    {r}\n" for r in rows)
+        + "  </table>\n"
+        f"  <p>{' | '.join(nav)}</p>\n"
+        "</body>\n</html>\n"
+    )
+
+
+def write_catalog(stanzas: List[str], page_size: int, verbose: bool):
+    catalog = build_catalog(stanzas)
+    records = [rec for rec, _ in catalog]
+    data = json.dumps(records, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    _write_if_changed(REPO_ROOT / 'packages.json', data)
+    # mtime=0 keeps the .gz byte-identical across runs with the same input
+    _write_if_changed(REPO_ROOT / 'packages.json.gz', gzip.compress(data, compresslevel=9, mtime=0))
+
+    CATALOG_DIR.mkdir(exist_ok=True)
+    manifest_path = CATALOG_DIR / 'manifest.json'
+    try:
+        manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        manifest = {}
+    old_pages: Dict[str, str] = manifest.get('pages', {}) if manifest.get('page_size') == page_size else {}
+
+    total_pages = max(1, (len(catalog) + page_size - 1) // page_size)
+    pages: Dict[str, str] = {}
+    written = 0
+    for page in range(1, total_pages + 1):
+        chunk = catalog[(page - 1) * page_size:page * page_size]
+        has_next = page < total_pages
+        h = hashlib.sha1(f"{page}/{has_next}".encode('utf-8'))
+        for _, stanza in chunk:
+            h.update(stanza.encode('utf-8'))
+            h.update(b'\0')
+        name = f"page-{page}.html"
+        pages[name] = h.hexdigest()
+        out_path = CATALOG_DIR / name
+        if old_pages.get(name) == pages[name] and out_path.exists():
+            continue
+        out_path.write_text(render_catalog_page([rec for rec, _ in chunk], page, has_next), encoding='utf-8')
+        written += 1
+        if verbose:
+            print(f"[catalog] wrote {name}")
+    for stale in CATALOG_DIR.glob('page-*.html'):
+        if stale.name not in pages:
+            stale.unlink()
+    manifest_path.write_text(json.dumps({'page_size': page_size, 'pages': pages}, indent=1), encoding='utf-8')
+    print(f"Wrote: packages.json ({len(records)} packages), catalog {written}/{total_pages} pages regenerated")
+
+
 def main():
     ap = argparse.ArgumentParser(description='Update APT repo Packages indices from deb files.')
     ap.add_argument('--only', nargs='*', help='Only update these deb basenames (e.g., ai.akemi.appsyncunified_116.0_iphoneos-arm.deb)')
@@ -240,7 +437,10 @@ def main():
     ap.add_argument('--add-icons', action='store_true', help='If matching icon images exist, set Icon: for each package')
     ap.add_argument('--icons-dir', help='Directory containing per-package icon images (default: ./icons)')
     ap.add_argument('--icon-url-prefix', help='Absolute URL prefix for icon files, e.g., https://example.com/repo/icons. If omitted, a relative path icons/<file> is used.')
+    ap.add_argument('--prune-superseded', type=int, nargs='?', const=1, metavar='N', help='Drop stanzas older than the newest N (default 1) per Package/Architecture and delete their debs')
     ap.add_argument('--no-compress', action='store_true', help='Do not write Packages.gz / Packages.bz2')
+    ap.add_argument('--no-catalog', action='store_true', help='Do not write packages.json / catalog/*.html')
+    ap.add_argument('--catalog-page-size', type=int, default=CATALOG_PAGE_SIZE, help=f'Packages per catalog HTML page (default {CATALOG_PAGE_SIZE})')
     ap.add_argument('--dry-run', action='store_true', help='Show planned changes without writing files')
     ap.add_argument('--verbose', action='store_true', help='Verbose output')
     args = ap.parse_args()
@@ -253,6 +453,11 @@ def main():
     raw = PKG_FILE.read_text(encoding='utf-8', newline='')
     stanzas = parse_stanzas(raw)
 
+    doomed: List[Path] = []
+    total_stanzas = len(stanzas)
+    if args.prune_superseded:
+        stanzas, doomed = prune_superseded(stanzas, max(1, args.prune_superseded), args.verbose or args.dry_run)
+
     only_set = set(args.only) if args.only else None
     icons_dir = Path(args.icons_dir).resolve() if args.icons_dir else ICONS_DIR_DEFAULT
     plans = build_update_plans(
@@ -265,7 +470,7 @@ def main():
         icon_url_prefix=args.icon_url_prefix,
     )
 
-    if not plans:
+    if not plans and len(stanzas) == total_stanzas:
         print('No stanzas matched deb files or --only selection; nothing to do.')
         return
 
@@ -277,6 +482,13 @@ def main():
         return
 
     write_outputs(new_content, args.no_compress)
+    # Only delete superseded debs once the index no longer references them
+    for deb_path in doomed:
+        deb_path.unlink(missing_ok=True)
+        if args.verbose:
+            print(f"[prune] deleted {deb_path.name}")
+    if not args.no_catalog:
+        write_catalog(new_stanzas, max(1, args.catalog_page_size), args.verbose)
 
 
 if __name__ == '__main__':